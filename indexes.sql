@@ -0,0 +1,13 @@
+-- Covering indexes for the polling query in main.py.
+-- Without them SQL Server does a clustered scan of FinalProducts and
+-- FinalWithResults on every cycle; with them each iteration should stay
+-- at single-digit logical reads (verify with SET STATISTICS IO ON).
+-- Run once per database, before starting the collector.
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_FinalProducts_id')
+    CREATE INDEX IX_FinalProducts_id ON FinalProducts (id)
+        INCLUDE (created_at, process_id, number, status, housing, pcb, arm);
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_FinalWithResults_pid')
+    CREATE INDEX IX_FinalWithResults_pid ON FinalWithResults (process_id)
+        INCLUDE ([action], [min], [max], [value]);
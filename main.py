@@ -1,7 +1,16 @@
+import atexit
+import functools
+import io
 import logging
+from logging.handlers import RotatingFileHandler
 import csv
 import os
+import re
 import configparser
+from collections import defaultdict
+import queue
+import signal
+import threading
 import time
 import datetime
 import pyodbc
@@ -33,147 +42,321 @@ last_id_file = config['Settings']['last_id_file']
 log_file = config['Settings']['log_file']
 csv_file_path = config['Settings']['csv_file_path']
 
-logging.basicConfig(filename=log_file, level=logging.DEBUG)
+# Rotacja logu: maks. 5 x 10 MB zamiast jednego rosnacego bez konca pliku
+_log_handler = RotatingFileHandler(log_file, maxBytes=10_000_000, backupCount=5,
+                                   encoding='utf-8')
+_log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+logging.getLogger().addHandler(_log_handler)
+logging.getLogger().setLevel(logging.INFO)
 
+# Atrybuty ODBC ustawiane przed polaczeniem (pyodbc nie ma stalej nazwanej)
+SQL_ATTR_PACKET_SIZE = 112
+# Ile nowych produktow pobieramy w jednym cyklu
+FETCH_TOP = 100
+# Ile wierszy sterownik pobiera w jednej paczce (TOP 100 miesci sie w jednej)
+FETCH_BATCH_SIZE = 128
 
-def get_connection():
-    """Return a connection to the database."""
-    conn = None
-    try:
-        conn_str = (f"DRIVER={db_driver};SERVER={db_server};DATABASE={db_name};"
-                    f"UID={db_user};PWD={db_password};TrustServerCertificate=Yes;")
-        conn = pyodbc.connect(conn_str)
+conn_str = (f"DRIVER={db_driver};SERVER={db_server};DATABASE={db_name};"
+            f"UID={db_user};PWD={db_password};TrustServerCertificate=Yes;")
+
+
+class ConnectionManager:
+    """Keep one long-lived database connection and reconnect after errors."""
+
+    def __init__(self, connection_string):
+        self._conn_str = connection_string
+        self._conn = None
+
+    def _connect(self):
+        # autocommit - workload jest tylko do odczytu, nie potrzebujemy transakcji
+        conn = pyodbc.connect(self._conn_str, autocommit=True,
+                              attrs_before={SQL_ATTR_PACKET_SIZE: 32768})
         print(f"Successfully connected to database: {db_name}")
         return conn
-    except Exception as e:
-        logging.error(f"Database connection error: {e}")
-        print(f"Database connection error: {e}")
-        if conn:
-            conn.close()
-        return None
+
+    def cursor(self):
+        if self._conn is None:
+            self._conn = self._connect()
+        try:
+            cursor = self._conn.cursor()
+        except pyodbc.Error:
+            self.close()
+            self._conn = self._connect()
+            cursor = self._conn.cursor()
+        cursor.arraysize = FETCH_BATCH_SIZE
+        return cursor
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except pyodbc.Error:
+                pass
+            finally:
+                self._conn = None
 
 
 def create_csv_if_not_exists(filename, headers):
     """Create a CSV file with headers if it does not exist."""
     if not os.path.exists(filename):
-        with open(filename, mode='w', newline='', encoding='utf-8') as f:
+        with open(filename, mode='w', newline='', encoding='utf-8', buffering=1 << 16) as f:
             writer = csv.DictWriter(f, fieldnames=headers)
             writer.writeheader()
 
 def read_last_id():
     """Read the last processed ID from a file."""
-    if os.path.exists(last_id_file):
-        with open(last_id_file, 'r') as f:
-            return int(f.read().strip())
-    return 0
+    # Niskopoziomowy odczyt bez warstwy tekstowej i bez osobnego stat()
+    try:
+        fd = os.open(last_id_file, os.O_RDONLY)
+    except FileNotFoundError:
+        return 0
+    try:
+        data = os.read(fd, 32)
+    finally:
+        os.close(fd)
+    return int(data.strip() or 0)
 
 def save_last_id(last_id):
-    """Save the last processed ID to a file."""
-    with open(last_id_file, 'w') as f:
+    """Save the last processed ID to a file (atomically, via a temp file)."""
+    tmp = last_id_file + '.tmp'
+    with open(tmp, 'w') as f:
         f.write(str(last_id))
+    os.replace(tmp, last_id_file)
 
-def get_actions():
-    """Fetch actions from the database."""
-    conn = None
-    try:
-        conn = get_connection()
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, name, minmax FROM actions ORDER BY action_order")
-            actions = cursor.fetchall()
-            return actions
-    finally:
-        if conn:
-            conn.close()
+SQL_ACTIONS = "SELECT id, name, minmax FROM actions ORDER BY action_order"
+
+_actions_cache = {'ts': 0.0, 'val': None}
+
+def get_actions(manager, ttl=600):
+    """Fetch actions from the database (cached for ttl seconds)."""
+    now = time.time()
+    if _actions_cache['val'] is not None and now - _actions_cache['ts'] < ttl:
+        return _actions_cache['val']
+    cursor = manager.cursor()
+    cursor.execute(SQL_ACTIONS)
+    actions = cursor.fetchall()
+    cursor.close()
+    _actions_cache['val'] = actions
+    _actions_cache['ts'] = now
     return actions
 
-def fetch_new_records(cursor, last_id, actions):
-    """Fetch new records from the database and group related records."""
-    cursor.execute("SELECT TOP 100 id, created_at, process_id, number, CASE WHEN SUBSTRING(CAST(status AS VARCHAR), 2, 1) = 3 THEN 'OK' ELSE 'NOK' END status, housing [housing no], pcb [pcb no], arm [arm no] FROM FinalProducts WHERE id > ? ORDER BY id ASC", last_id)
+def invalidate_actions_cache(*_args):
+    """Drop the cached actions so the next get_actions call hits the database."""
+    _actions_cache['val'] = None
+
+# SIGHUP pozwala wymusic odswiezenie akcji bez restartu procesu
+# (na Windows ten sygnal nie istnieje)
+if hasattr(signal, 'SIGHUP'):
+    signal.signal(signal.SIGHUP, invalidate_actions_cache)
+
+# Nazwy akcji pochodza z bazy - do SQL wstawiamy tylko te, ktore przechodza
+# przez biala liste znakow (ochrona przed SQL injection).
+_ACTION_NAME_RE = re.compile(r"^[\w .,:%°()\-/]+$")
+
+def build_action_columns(actions):
+    """Compile the action-name -> (min, value, max) column-name table once.
+
+    Returns [(name, (min_col, val_col, max_col)), ...]; min/max columns are
+    None for actions without a tolerance range. All CSV/SQL column names for
+    an action come from this table, so nothing concatenates key strings later.
+    """
+    table = []
+    for action in actions:
+        name, minmax = action[1], action[2]
+        if not _ACTION_NAME_RE.match(name):
+            logging.error(f"Skipping action with unsafe name: {name!r}")
+            continue
+        if minmax == 1:
+            table.append((name, (f"{name} .min", name, f"{name} .max")))
+        else:
+            table.append((name, (None, name, None)))
+    return table
+
+def build_pivot_sql(actions):
+    """Build the SELECT that returns new products with results pivoted into columns."""
+    pieces = []
+    aliases = []
+    for name, (min_col, val_col, max_col) in build_action_columns(actions):
+        if min_col:
+            pieces.append(f"MAX(CASE WHEN [action] = '{name}' THEN [min] END) AS [{min_col}]")
+            aliases.append(f"r.[{min_col}]")
+        pieces.append(f"MAX(CASE WHEN [action] = '{name}' THEN [value] END) AS [{val_col}]")
+        aliases.append(f"r.[{val_col}]")
+        if max_col:
+            pieces.append(f"MAX(CASE WHEN [action] = '{name}' THEN [max] END) AS [{max_col}]")
+            aliases.append(f"r.[{max_col}]")
+
+    # process_id jest potrzebny tylko w warunku JOINa - nie wybieramy go,
+    # wiec wynik zapytania to dokladnie kolumny pliku CSV
+    base_columns = ("fp.id, fp.created_at, fp.number, "
+                    "CASE WHEN SUBSTRING(CAST(fp.status AS VARCHAR), 2, 1) = 3 THEN 'OK' ELSE 'NOK' END status, "
+                    "fp.housing [housing no], fp.pcb [pcb no], fp.arm [arm no]")
+    if not pieces:
+        return (f"SELECT TOP {FETCH_TOP} {base_columns} FROM FinalProducts fp "
+                "WHERE fp.id > ? ORDER BY fp.id ASC")
+    return (f"SELECT TOP {FETCH_TOP} {base_columns}, {', '.join(aliases)} "
+            "FROM FinalProducts fp "
+            f"LEFT JOIN (SELECT process_id, {', '.join(pieces)} "
+            "FROM FinalWithResults GROUP BY process_id) r ON r.process_id = fp.process_id "
+            "WHERE fp.id > ? ORDER BY fp.id ASC")
+
+def fetch_new_records(cursor, last_id, pivot_sql):
+    """Fetch new records with their pivoted results in a single query.
+
+    Returns (columns, rows) with rows kept as driver row tuples - the column
+    set is fixed by the pivot SQL, so nothing is rewrapped into per-row dicts.
+    """
+    cursor.execute(pivot_sql, last_id)
     columns = [column[0] for column in cursor.description]
-    new_records = [dict(zip(columns, row)) for row in cursor.fetchall()]
-    processed_records = []
-
-    for record in new_records:
-        product_id = record.get('process_id')
-        record.pop('process_id')
-        if product_id is not None:
-            cursor.execute("SELECT action, min, max, value FROM FinalWithResults WHERE process_id = ?", product_id)
-            related_columns = [column[0] for column in cursor.description]
-            related_records = [dict(zip(related_columns, row)) for row in cursor.fetchall()]
-
-            grouped_data = {}
-            for action in actions:
-                for rel_record in related_records:
-                    if action[1] == rel_record['action']:
-                        if action[2] == 1:
-                            grouped_data[rel_record['action'] + " .min"] = rel_record['min']
-                            grouped_data[rel_record['action']] = rel_record['value']
-                            grouped_data[rel_record['action'] + " .max"] = rel_record['max']
-                        else:
-                            grouped_data[rel_record['action']] = rel_record['value']
-
-            # Dodaj zgrupowane dane do głównego rekordu
-            record.update(grouped_data)
-
-        processed_records.append(record)
-
-    return processed_records
-
-def append_to_csv_by_month(rows, timestamp_column):
-    """Append records to CSV files grouped by month."""
-    grouped = {}
+    rows = []
+    while True:
+        batch = cursor.fetchmany(FETCH_BATCH_SIZE)
+        if not batch:
+            break
+        rows.extend(batch)
+    return columns, rows
 
-    for row in rows:
-        record_ts = row[timestamp_column]
-        if isinstance(record_ts, str):
-            record_ts = datetime.datetime.fromisoformat(record_ts)
+# Otwarte deskryptory plikow CSV trzymamy miedzy iteracjami:
+# {filename: (fd, last_used)}
+_csv_handles = {}
+_CSV_HANDLE_TTL = 600  # po 10 min bez zapisu zamykamy plik (np. po zmianie miesiaca)
+
+def _close_csv_handles():
+    for fd, _ts in _csv_handles.values():
+        os.close(fd)
+    _csv_handles.clear()
+
+atexit.register(_close_csv_handles)
+
+def _get_csv_fd(filename, headers):
+    """Return a cached O_APPEND file descriptor, opening it once per month."""
+    now = time.monotonic()
+    handle = _csv_handles.get(filename)
+    if handle is None:
+        create_csv_if_not_exists(filename, headers)
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT
+                     | getattr(os, 'O_BINARY', 0), 0o644)
+        _csv_handles[filename] = (fd, now)
+    else:
+        fd, _ts = handle
+        _csv_handles[filename] = (fd, now)
+    # Zamknij deskryptory, do ktorych dawno nic nie dopisywalismy
+    for name in [n for n, h in _csv_handles.items() if now - h[1] > _CSV_HANDLE_TTL]:
+        old_fd, _ts = _csv_handles.pop(name)
+        os.close(old_fd)
+    return fd
+
+@functools.lru_cache(maxsize=64)
+def _month_filename(year, month):
+    return f"{csv_file_path}Wyroby_gotowe_{month:02d}-{year}.csv"
 
-        filename = f"{csv_file_path}Wyroby_gotowe_{record_ts.strftime('%m-%Y')}.csv"
-        if filename not in grouped:
-            grouped[filename] = []
+def append_to_csv_by_month(columns, rows, timestamp_column):
+    """Append record rows to CSV files grouped by month."""
+    ts_idx = columns.index(timestamp_column)
+    grouped = defaultdict(list)
 
+    # Typ znacznika czasu jest jednorodny w paczce - sprawdzamy raz,
+    # a nazwe pliku miesiaca bierzemy z cache zamiast strftime per wiersz
+    parse = datetime.datetime.fromisoformat if isinstance(rows[0][ts_idx], str) else None
+
+    for row in rows:
+        record_ts = row[ts_idx]
+        if parse is not None:
+            record_ts = parse(record_ts)
+
+        filename = _month_filename(record_ts.year, record_ts.month)
         grouped[filename].append(row)
 
     for filename, records in grouped.items():
-        headers = records[0].keys()
-        create_csv_if_not_exists(filename, headers)
-        with open(filename, mode='a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=headers)
-            writer.writerows(records)
+        # Zserializuj cala paczke do bufora w pamieci i zapisz jednym
+        # os.write() na deskryptorze O_APPEND - jeden syscall na paczke.
+        buf = io.StringIO()
+        csv.writer(buf).writerows(records)
+        os.write(_get_csv_fd(filename, columns), buf.getvalue().encode('utf-8'))
+
+def writer_loop(q):
+    """Consume fetched batches: append to CSV and persist the watermark."""
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        columns, rows = item
+        # Nieudany zapis (np. pelny dysk, zablokowany plik na udziale)
+        # ponawiamy na tej samej paczce, az sie uda - pelna kolejka
+        # wstrzyma wtedy watek pobierajacy, a znacznik na dysku nigdy
+        # nie przeskoczy niezapisanych wierszy.
+        retry = 1.0
+        while True:
+            try:
+                append_to_csv_by_month(columns, rows, timestamp_column="created_at")
+                # Znacznik na dysku przesuwamy dopiero po udanym zapisie CSV
+                save_last_id(rows[-1][columns.index("id")])
+                print(f"[{datetime.datetime.now()}] Added {len(rows)} products.")
+                # logging.info(f"[{datetime.datetime.now()}] Added {len(rows)} products.")
+                break
+            except Exception as e:
+                print(f"ERROR: CSV write failed, retrying. Please check the log file.")
+                logging.error(f"{e}")
+                time.sleep(retry)
+                retry = min(retry * 2, interval_seconds)
 
 def main_loop():
-    conn = None
-    cursor = None
+    manager = ConnectionManager(conn_str)
+    # Pobieranie z bazy i zapis CSV biegna rownolegle: ten watek pobiera
+    # paczke N+1, gdy watek zapisujacy dopisuje paczke N do pliku.
+    q = queue.Queue(maxsize=2)
+    writer = threading.Thread(target=writer_loop, args=(q,), daemon=True)
+    writer.start()
     try:
-        conn = get_connection()
-        if conn:
-            cursor = conn.cursor()
-            actions = get_actions()
-
-            while True:
-                try:
-                    last_id = read_last_id()
-                    rows = fetch_new_records(cursor, last_id, actions)
-                    if rows:
-                        append_to_csv_by_month(rows, timestamp_column="created_at")
-                        save_last_id(rows[-1]["id"])
-                        print(f"[{datetime.datetime.now()}] Added {len(rows)} products.")
-                        # logging.info(f"[{datetime.datetime.now()}] Added {len(rows)} products.")
-                    else:
-                        print(f"[{datetime.datetime.now()}] New products not found.")
-                        # logging.info(f"[{datetime.datetime.now()}] New products not found.")
-
-                except Exception as e:
-                    print(f"ERROR: Some error occurred. Please check the log file.")
-                    logging.error(f"{e}")
-
-                time.sleep(interval_seconds)
+        actions = get_actions(manager)
+        pivot_sql = build_pivot_sql(actions)
+        # Proces jest jedynym autorem pliku last_id, wiec czytamy go raz
+        # na starcie i dalej trzymamy wartosc w pamieci.
+        last_id = read_last_id()
+        # Adaptacyjny odstep miedzy zapytaniami: krotki gdy dane plyna,
+        # wydluzany wykladniczo do interval_seconds gdy nic nie przychodzi.
+        idle = float(interval_seconds)
+        # Jeden kursor na caly czas zycia petli: pyodbc przygotowuje zapytanie
+        # przy pierwszym execute i przy kolejnych iteracjach (ten sam tekst SQL,
+        # ten sam kursor) pomija parsowanie/bindowanie.
+        cursor = None
+
+        while True:
+            try:
+                if cursor is None:
+                    cursor = manager.cursor()
+                columns, rows = fetch_new_records(cursor, last_id, pivot_sql)
+                if rows:
+                    # W pamieci przesuwamy kursor od razu (potrzebny do
+                    # nastepnego zapytania); na dysk zapisuje watek writer.
+                    last_id = rows[-1][columns.index("id")]
+                    q.put((columns, rows))
+                    idle = 0.5
+                else:
+                    print(f"[{datetime.datetime.now()}] New products not found.")
+                    # logging.info(f"[{datetime.datetime.now()}] New products not found.")
+                    idle = min(idle * 2, interval_seconds)
+
+            except pyodbc.Error as e:
+                # Zerwane polaczenie - zamknij, manager polaczy sie ponownie
+                # przy nastepnej iteracji.
+                cursor = None
+                manager.close()
+                print(f"ERROR: Database error occurred. Please check the log file.")
+                logging.error(f"{e}")
+                idle = float(interval_seconds)
+            except Exception as e:
+                print(f"ERROR: Some error occurred. Please check the log file.")
+                logging.error(f"{e}")
+                idle = float(interval_seconds)
+
+            time.sleep(idle)
     except Exception as e:
         print(f"ERROR: Main loop error: {e}")
     finally:
-        if conn:
-            conn.close()
+        q.put(None)
+        writer.join(timeout=30)
+        manager.close()
 
 if __name__ == "__main__":
     main_loop()